@@ -4,17 +4,18 @@ import aiofiles
 import aiohttp
 import asyncio
 import logging
+import orjson
 import os
 import re
 import sys
 import time
 import tomli
-import ujson
 import unicodedata
 import urllib.parse
 
 from aiohttp.client_exceptions import ClientOSError, ServerDisconnectedError
 from aiohttp.resolver import AsyncResolver
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
 from filelock import FileLock, Timeout
 from glob import glob
@@ -37,6 +38,8 @@ app = Sanic("movistar_epg")
 
 log = logging.getLogger("EPG")
 
+JSON_OPTS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+
 
 @app.listener("before_server_start")
 async def before_server_start(app, loop):
@@ -65,7 +68,6 @@ async def before_server_start(app, loop):
             resolver=AsyncResolver(nameservers=[IPTV_DNS]) if not WIN32 else None,
         ),
         headers={"User-Agent": UA},
-        json_serialize=ujson.dumps,
     )
 
     await reload_epg()
@@ -81,16 +83,12 @@ async def before_server_start(app, loop):
                 os.makedirs(RECORDINGS)
                 return
 
-            oldest_epg = 9999999999
-            for channel_id in _EPGDATA:
-                first = next(iter(_EPGDATA[channel_id]))
-                if first < oldest_epg:
-                    oldest_epg = first
+            oldest_epg = min((starts[0] for starts in _EPGSTARTS.values() if starts), default=9999999999)
 
             _indexed = set()
             try:
-                async with aiofiles.open(recordings, encoding="utf8") as f:
-                    recordingsdata = ujson.loads(await f.read())
+                async with aiofiles.open(recordings, "rb") as f:
+                    recordingsdata = orjson.loads(await f.read())
                 int_recordings = {}
                 for str_channel in recordingsdata:
                     channel_id = int(str_channel)
@@ -155,6 +153,12 @@ def before_server_stop(app=None, loop=None):
     [task.cancel() for task in asyncio.all_tasks()]
 
 
+@app.listener("after_server_stop")
+async def after_server_stop(app, loop):
+    if _SESSION_CLOUD:
+        await _SESSION_CLOUD.close()
+
+
 async def alive():
     async with aiohttp.ClientSession(headers={"User-Agent": UA_U7D}) as session:
         for i in range(10):
@@ -204,10 +208,15 @@ def get_epg(channel_id, program_id, cloud=False):
         log.error(f"{channel_id=} not found")
         return
 
-    for timestamp in sorted(guide[channel_id]):
-        _epg = guide[channel_id][timestamp]
-        if program_id == _epg["pid"]:
-            return _epg, timestamp
+    if not cloud:
+        timestamp = _EPGPIDS[channel_id].get(program_id)
+        if timestamp:
+            return _EPGDATA[channel_id][timestamp], timestamp
+    else:
+        for timestamp in sorted(_CLOUD[channel_id]):
+            _epg = _CLOUD[channel_id][timestamp]
+            if program_id == _epg["pid"]:
+                return _epg, timestamp
     log.error(f"{channel_id=} {program_id=} not found")
 
 
@@ -226,17 +235,15 @@ def get_program_id(channel_id, url=None, cloud=False):
         return
 
     channel = _CHANNELS[channel_id]["name"]
-    last_timestamp = new_start = 0
+    new_start = 0
 
     if not cloud:
         if start not in _EPGDATA[channel_id]:
-            for timestamp in _EPGDATA[channel_id]:
-                if timestamp > start:
-                    break
-                last_timestamp = timestamp
-            if not last_timestamp:
+            starts = _EPGSTARTS[channel_id]
+            pos = bisect_right(starts, start)
+            if not pos:
                 return
-            start, new_start = last_timestamp, start
+            start, new_start = starts[pos - 1], start
         program_id, duration = [_EPGDATA[channel_id][start][t] for t in ["pid", "duration"]]
     else:
         if channel_id not in _CLOUD:
@@ -374,6 +381,7 @@ async def handle_archive(request, channel_id, program_id, cloud=False):
 
             _prune_duplicates()
             _RECORDINGS[channel_id][timestamp] = {"filename": filename}
+            await save_recordings()
 
         app.add_task(update_recordings(channel_id))
 
@@ -464,6 +472,19 @@ async def handle_timers_check(request):
     return response.json({"status": "Timers check queued"}, 200)
 
 
+def index_epg(channels=None):
+    global _EPGPIDS, _EPGSTARTS
+
+    if channels is None:  # Full rebuild, dropping channels no longer in the EPG
+        _EPGPIDS, _EPGSTARTS, channels = {}, {}, _EPGDATA
+
+    for channel_id in channels:
+        epg = _EPGDATA[channel_id]
+        _EPGSTARTS[channel_id] = sorted(epg)
+        # Walk backwards so a program id aired more than once maps to its first airing
+        _EPGPIDS[channel_id] = {epg[ts]["pid"]: ts for ts in reversed(_EPGSTARTS[channel_id])}
+
+
 async def kill_vod():
     vods = await ongoing_vods()
     if not vods:
@@ -638,11 +659,11 @@ async def reload_epg():
         int_channels, int_epgdata, services = {}, {}, {}
 
         try:
-            async with aiofiles.open(epg_metadata, encoding="utf8") as f:
-                metadata = ujson.loads(await f.read())["data"]
+            async with aiofiles.open(epg_metadata, "rb") as f:
+                metadata = orjson.loads(await f.read())["data"]
 
-            async with aiofiles.open(config_data, encoding="utf8") as f:
-                packages = ujson.loads(await f.read())["data"]["tvPackages"]
+            async with aiofiles.open(config_data, "rb") as f:
+                packages = orjson.loads(await f.read())["data"]["tvPackages"]
 
             for package in packages.split("|") if packages != "ALL" else metadata["packages"]:
                 services = {**services, **metadata["packages"][package]["services"]}
@@ -663,14 +684,15 @@ async def reload_epg():
             return await reload_epg()
 
         try:
-            async with aiofiles.open(epg_data, encoding="utf8") as f:
-                epgdata = ujson.loads(await f.read())["data"]
+            async with aiofiles.open(epg_data, "rb") as f:
+                epgdata = orjson.loads(await f.read())["data"]
 
             for channel in epgdata:
                 int_epgdata[int(channel)] = {}
                 for timestamp in epgdata[channel]:
                     int_epgdata[int(channel)][int(timestamp)] = epgdata[channel][timestamp]
             _EPGDATA = int_epgdata
+            index_epg()
 
         except (FileNotFoundError, TypeError, ValueError) as ex:
             log.error(f"Failed to load EPG data {repr(ex)}")
@@ -686,6 +708,10 @@ async def reload_epg():
         log.info(f"Total: {len(_EPGDATA)} Channels & {nr_epg} EPG entries")
 
 
+async def save_recordings():
+    await asyncio.get_running_loop().run_in_executor(None, write_json, _RECORDINGS, recordings)
+
+
 async def timers_check(delay=0):
     await asyncio.sleep(delay)
 
@@ -708,7 +734,7 @@ async def timers_check(delay=0):
             try:
                 _timers = tomli.loads(await f.read())
             except ValueError:
-                _timers = ujson.loads(await f.read())
+                _timers = orjson.loads(await f.read())
     except (TypeError, ValueError) as ex:
         log.error(f"Failed to parse timers.conf: {repr(ex)}")
         return
@@ -720,7 +746,7 @@ async def timers_check(delay=0):
         return unicodedata.normalize("NFKD", string).encode("ASCII", "ignore").decode("utf8")
 
     async def _record(cloud=False):
-        nonlocal channel_id, channel_name, ongoing, queued, nr_procs, recs, timer_match, timestamp, vo
+        nonlocal channel_id, channel_name, ongoing, queued, nr_procs, recorded, timer_regex, timestamp, vo
 
         filename = get_recording_name(channel_id, timestamp, cloud)
         if filename in ongoing or (channel_id, timestamp) in queued:
@@ -732,10 +758,10 @@ async def timers_check(delay=0):
         if not cloud and timestamp + duration >= _last_epg:
             return
 
-        if channel_id in recs and filename in str(recs[channel_id]):
+        if filename in recorded.get(channel_id, ""):
             return
 
-        if cloud or re.search(_clean(timer_match), _clean(title), re.IGNORECASE):
+        if cloud or timer_regex.search(_clean(title)):
             if await record_program(channel_id, pid, 0, 0 if cloud else duration, cloud, MP4_OUTPUT, vo):
                 return
 
@@ -745,7 +771,7 @@ async def timers_check(delay=0):
                 f"{' [VO]' if vo else ''}"
             )
 
-            queued.append((channel_id, timestamp))
+            queued.add((channel_id, timestamp))
             await asyncio.sleep(2.5 if not WIN32 else 4)
 
             nr_procs += 1
@@ -756,9 +782,12 @@ async def timers_check(delay=0):
     async with recordings_lock:
         recs = _RECORDINGS.copy()
 
+    # Archived filenames per channel, joined once so partial matches are still found
+    recorded = {ch: "\n".join(recs[ch][ts]["filename"] for ts in recs[ch]) for ch in recs}
+
     ongoing = await ongoing_vods(_all=True)  # we want to check against all ongoing vods, also in pp
     log.debug(f"Ongoing VODs: [{ongoing}]")
-    queued = []
+    queued = set()
 
     for str_channel_id in _timers.get("match", {}):
         channel_id = int(str_channel_id)
@@ -786,8 +815,10 @@ async def timers_check(delay=0):
                     else:
                         lang = res
             vo = lang == "VO"
+            timer_regex = re.compile(_clean(timer_match), re.IGNORECASE)
 
-            timestamps = [ts for ts in reversed(_EPGDATA[channel_id]) if ts < _last_epg]
+            starts = _EPGSTARTS[channel_id]
+            timestamps = starts[: bisect_left(starts, _last_epg)][::-1]
             if fixed_timer:
                 # fixed timers are checked daily, so we want today's and all of last week
                 fixed_timestamps = [fixed_timer] if fixed_timer < _last_epg else []
@@ -822,8 +853,8 @@ async def update_cloud():
     global _CLOUD, _EPGDATA
 
     try:
-        async with aiofiles.open(cloud_data, encoding="utf8") as f:
-            clouddata = ujson.loads(await f.read())["data"]
+        async with aiofiles.open(cloud_data, "rb") as f:
+            clouddata = orjson.loads(await f.read())["data"]
 
         int_clouddata = {}
         for channel in clouddata:
@@ -858,14 +889,14 @@ async def update_cloud():
         return {
             "age_rating": data["ageRatingID"],
             "duration": data["duration"],
-            "end": int(str(data["endTime"])[:-3]),
+            "end": data["endTime"] // 1000,
             "episode": episode,
             "full_title": meta["full_title"],
             "genre": data["theme"],
             "is_serie": meta["is_serie"],
             "pid": pid,
             "season": season,
-            "start": int(timestamp),
+            "start": timestamp,
             "year": year,
             "serie": serie,
             "serie_id": data.get("seriesID"),
@@ -874,7 +905,7 @@ async def update_cloud():
     new_cloud = {}
     for _event in cloud_recordings:
         channel_id = _event["serviceUID"]
-        timestamp = int(_event["beginTime"] / 1000)
+        timestamp = _event["beginTime"] // 1000
 
         if channel_id not in new_cloud:
             new_cloud[channel_id] = {}
@@ -907,24 +938,27 @@ async def update_cloud():
                     new_cloud[channel_id][timestamp]["episode_title"] = meta["episode_title"]
 
     updated = False
-    if new_cloud and (not _CLOUD or set(new_cloud) != set(_CLOUD)):
+    if new_cloud and (not _CLOUD or new_cloud.keys() != _CLOUD.keys()):
         updated = True
     else:
         for id in new_cloud:
-            if set(new_cloud[id]) != set(_CLOUD[id]):
+            if new_cloud[id].keys() != _CLOUD[id].keys():
                 updated = True
                 break
 
+    merged = set()
     for channel_id in new_cloud:
         if channel_id not in _EPGDATA:
             _EPGDATA[channel_id] = {}
-        for timestamp in list(set(new_cloud[channel_id]) - set(_EPGDATA[channel_id])):
+        for timestamp in [ts for ts in new_cloud[channel_id] if ts not in _EPGDATA[channel_id]]:
             _EPGDATA[channel_id][timestamp] = new_cloud[channel_id][timestamp]
+            merged.add(channel_id)
+    if merged:
+        index_epg(merged)
 
     if updated:
         _CLOUD = new_cloud
-        async with aiofiles.open(cloud_data, "w", encoding="utf8") as f:
-            await f.write(ujson.dumps({"data": _CLOUD}, ensure_ascii=False, indent=4, sort_keys=True))
+        await asyncio.get_running_loop().run_in_executor(None, write_json, {"data": _CLOUD}, cloud_data)
 
     if updated or not os.path.exists(CHANNELS_CLOUD) or not os.path.exists(GUIDE_CLOUD):
         if not os.path.exists(CHANNELS_CLOUD) or not os.path.exists(GUIDE_CLOUD):
@@ -980,14 +1014,13 @@ async def update_recordings(archive=False):
         for file in files:
             filename, ext = os.path.splitext(file)
             relname = filename[len(RECORDINGS) + 1 :]
-            if os.path.exists(filename + ".jpg"):
+            dirname, basename = os.path.split(filename)
+            jpgs = logos.get(dirname, [])
+            if basename + ".jpg" in jpgs:
                 logo = relname + ".jpg"
             else:
-                _logo = glob_safe(f"{filename}*.jpg")
-                if len(_logo) and os.path.isfile(_logo[0]):
-                    logo = _logo[0][len(RECORDINGS) + 1 :]
-                else:
-                    logo = ""
+                logo = next((jpg for jpg in jpgs if jpg.startswith(basename)), "")
+                logo = os.path.join(dirname, logo)[len(RECORDINGS) + 1 :] if logo else ""
             path, name = [t.replace(",", ":").replace(" - ", ": ") for t in os.path.split(relname)]
             m3u += '#EXTINF:-1 group-title="'
             m3u += '# Recientes"' if latest else f'{path}"' if path else '#"'
@@ -998,22 +1031,36 @@ async def update_recordings(archive=False):
             m3u += urllib.parse.quote(relname + ext) + "\n"
         return m3u
 
-    async with recordings_lock:
-        if archive and _RECORDINGS:
-            async with aiofiles.open(recordings + ".tmp", "w", encoding="utf8") as f:
-                await f.write(ujson.dumps(_RECORDINGS, ensure_ascii=False, indent=4, sort_keys=True))
-            if WIN32 and os.path.exists(recordings):
-                os.remove(recordings)
-            os.rename(recordings + ".tmp", recordings)
-
-        while True:
+    def _scan_files():
+        files, logos, mtimes = [], {}, {}
+        dirs = [RECORDINGS]
+        while dirs:
             try:
-                _files = glob(f"{RECORDINGS}/**", recursive=True)
-                _files = list(filter(lambda x: os.path.splitext(x)[1] in VID_EXTS, _files))
-                _files.sort(key=os.path.getmtime)
-                break
-            except FileNotFoundError:
-                await asyncio.sleep(1)
+                entries = list(os.scandir(dirs.pop()))
+            except OSError:  # Missing or unreadable directory, skip it like glob does
+                continue
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                ext = os.path.splitext(entry.name)[1]
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                elif ext in VID_EXTS:
+                    try:
+                        mtimes[entry.path] = entry.stat().st_mtime
+                    except OSError:  # Vanished since the directory was listed
+                        continue
+                    files.append(entry.path)
+                elif ext == ".jpg":
+                    logos.setdefault(os.path.dirname(entry.path), []).append(entry.name)
+        files.sort(key=mtimes.get)
+        return files, logos, mtimes
+
+    async with recordings_lock:
+        if archive is True and _RECORDINGS:
+            await save_recordings()
+
+        _files, logos, mtimes = _scan_files()
 
         if RECORDINGS_PER_CHANNEL:
             if not isinstance(archive, bool):
@@ -1046,7 +1093,7 @@ async def update_recordings(archive=False):
                     if not os.path.isdir(subdir):
                         continue
                     try:
-                        newest = os.path.getmtime(list(filter(lambda x: x.startswith(subdir), files))[-1])
+                        newest = mtimes[list(filter(lambda x: x.startswith(subdir), files))[-1]]
                     except IndexError:
                         continue
                     os.utime(subdir, (-1, newest))
@@ -1065,7 +1112,7 @@ async def update_recordings(archive=False):
             async with aiofiles.open(m3u_file, "w", encoding="utf8") as f:
                 await f.write(m3u)
 
-            newest = int(os.path.getmtime(files[-1]))
+            newest = int(mtimes[files[-1]])
             [os.utime(file, (-1, newest)) for file in (m3u_file, os.path.join(RECORDINGS, dir))]
 
             if RECORDINGS_PER_CHANNEL and len(topdirs):
@@ -1077,6 +1124,12 @@ async def update_recordings(archive=False):
             log.info(f"Local Recordings Updated => {U7D_URL}/Recordings.m3u")
 
 
+def write_json(data, filename):
+    with open(filename + ".tmp", "wb") as f:
+        f.write(orjson.dumps(data, option=JSON_OPTS))
+    os.replace(filename + ".tmp", filename)
+
+
 if __name__ == "__main__":
     if not WIN32:
         import signal
@@ -1090,6 +1143,8 @@ if __name__ == "__main__":
     _CHANNELS = {}
     _CLOUD = {}
     _EPGDATA = {}
+    _EPGPIDS = {}
+    _EPGSTARTS = {}
     _RECORDINGS = {}
     _RECORDINGS_INC = {}
 
@@ -3,8 +3,7 @@
 import aiofiles
 import aiohttp
 import asyncio
-import asyncio_dgram
-import json
+import errno
 import logging
 import os
 import socket
@@ -13,7 +12,7 @@ import time
 import ujson
 import urllib.parse
 
-from aiohttp.client_exceptions import ClientOSError, ServerDisconnectedError
+from aiohttp.client_exceptions import ClientOSError, ClientPayloadError, ServerDisconnectedError
 from aiohttp.resolver import AsyncResolver
 from collections import namedtuple
 from contextlib import closing
@@ -33,7 +32,7 @@ else:
     from asyncio import CancelledError
 
 from mu7d import EPG_URL, IPTV_DNS, MIME_M3U, MIME_TS, MIME_WEBM, UA, URL_COVER, URL_LOGO, WIN32, YEAR_SECONDS
-from mu7d import find_free_port, get_iptv_ip, mu7d_config, ongoing_vods, _version
+from mu7d import get_iptv_ip, mu7d_config, ongoing_vods, _version
 from movistar_vod import Vod
 
 
@@ -41,6 +40,34 @@ app = Sanic("movistar_u7d")
 
 log = logging.getLogger("U7D")
 
+UDP_BATCH = 64 * 1024
+UDP_MTU = 2048
+UDP_RCVBUF = 4 * 1024 * 1024  # Capped by the kernel to net.core.rmem_max
+UDP_VLEN = UDP_BATCH // UDP_MTU
+
+recvmmsg = None
+if sys.platform == "linux":
+    import ctypes
+
+    class Iovec(ctypes.Structure):
+        _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+    class Msghdr(ctypes.Structure):
+        _fields_ = [
+            ("msg_name", ctypes.c_void_p),
+            ("msg_namelen", ctypes.c_uint32),
+            ("msg_iov", ctypes.POINTER(Iovec)),
+            ("msg_iovlen", ctypes.c_size_t),
+            ("msg_control", ctypes.c_void_p),
+            ("msg_controllen", ctypes.c_size_t),
+            ("msg_flags", ctypes.c_int),
+        ]
+
+    class Mmsghdr(ctypes.Structure):
+        _fields_ = [("msg_hdr", Msghdr), ("msg_len", ctypes.c_uint)]
+
+    recvmmsg = getattr(ctypes.CDLL(None, use_errno=True), "recvmmsg", None)
+
 
 @app.listener("before_server_start")
 async def before_server_start(app, loop):
@@ -52,13 +79,14 @@ async def before_server_start(app, loop):
     app.config.RESPONSE_TIMEOUT = 1
 
     _SESSION = aiohttp.ClientSession(
-        connector=aiohttp.TCPConnector(keepalive_timeout=YEAR_SECONDS, limit_per_host=1),
+        connector=aiohttp.TCPConnector(keepalive_timeout=YEAR_SECONDS),
         json_serialize=ujson.dumps,
     )
     _SESSION_LOGOS = aiohttp.ClientSession(
         connector=aiohttp.TCPConnector(
             keepalive_timeout=YEAR_SECONDS,
             resolver=AsyncResolver(nameservers=[IPTV_DNS]) if not WIN32 else None,
+            ttl_dns_cache=3600,
         ),
         headers={"User-Agent": UA},
         json_serialize=ujson.dumps,
@@ -68,10 +96,7 @@ async def before_server_start(app, loop):
         try:
             async with _SESSION.get(f"{EPG_URL}/channels/") as r:
                 if r.status == 200:
-                    _CHANNELS = json.loads(
-                        await r.text(),
-                        object_hook=lambda d: {int(k) if k.isdigit() else k: v for k, v in d.items()},
-                    )
+                    _CHANNELS = {int(k): v for k, v in ujson.loads(await r.text()).items()}
                     break
                 else:
                     await asyncio.sleep(5)
@@ -88,14 +113,7 @@ async def before_server_start(app, loop):
 
 @app.listener("after_server_start")
 async def after_server_start(app, loop):
-    app.ctx.vod_client = aiohttp.ClientSession(
-        connector=aiohttp.TCPConnector(
-            keepalive_timeout=YEAR_SECONDS,
-            resolver=AsyncResolver(nameservers=[IPTV_DNS]) if not WIN32 else None,
-        ),
-        headers={"User-Agent": UA},
-        json_serialize=ujson.dumps,
-    )
+    app.ctx.vod_client = _SESSION_LOGOS
 
     banner = f"Movistar U7D - U7D v{_version}"
     if U7D_THREADS > 1:
@@ -116,6 +134,13 @@ async def before_server_stop(app, loop):
             pass
 
 
+@app.listener("after_server_stop")
+async def after_server_stop(app, loop):
+    for session in (_SESSION, _SESSION_LOGOS):
+        if session:
+            await session.close()
+
+
 def get_channel_id(channel_name):
     return [
         chan
@@ -153,14 +178,15 @@ async def handle_channel(request, channel_id=None, channel_name=None):
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
     sock.bind((mc_grp if not WIN32 else "", int(mc_port)))
     sock.setsockopt(
         socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(mc_grp) + socket.inet_aton(_IPTV)
     )
 
-    with closing(await asyncio_dgram.from_socket(sock)) as stream:
+    with closing(UdpRelay(sock, skip=28)) as relay:
         _response = await request.respond(content_type=MIME_TS)
-        await _response.send((await stream.recv())[0][28:])
+        await _response.send(await relay.read())
 
         prom = app.add_task(
             send_prom_event(
@@ -177,7 +203,7 @@ async def handle_channel(request, channel_id=None, channel_name=None):
 
         try:
             while True:
-                await _response.send((await stream.recv())[0][28:])
+                await _response.send(await relay.read())
 
         finally:
             prom.cancel()
@@ -216,13 +242,17 @@ async def handle_flussonic(request, url, channel_id=None, channel_name=None, clo
         log.warning(f"[{request.ip}] {_raw_url} -> Network Saturated")
         raise ServiceUnavailable("Network Saturated")
 
-    client_port = find_free_port(_IPTV)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+    sock.bind((_IPTV, 0))
+    client_port = sock.getsockname()[1]
+
     args = VodArgs(channel_id, program_id, request.ip, client_port, offset, cloud)
     vod = app.add_task(Vod(args, request.app.ctx.vod_client))
 
-    with closing(await asyncio_dgram.bind((_IPTV, client_port))) as stream:
+    with closing(UdpRelay(sock)) as relay:
         _response = await request.respond(content_type=MIME_TS)
-        await _response.send((await stream.recv())[0])
+        await _response.send(await relay.read())
 
         prom = app.add_task(
             send_prom_event(
@@ -241,7 +271,7 @@ async def handle_flussonic(request, url, channel_id=None, channel_name=None, clo
 
         try:
             while True:
-                await _response.send((await stream.recv())[0])
+                await _response.send(await relay.read())
 
         finally:
             vod.cancel()
@@ -298,17 +328,18 @@ async def handle_logos(request, cover=None, logo=None, path=None):
     if request.method == "HEAD":
         return response.HTTPResponse(content_type="image/jpeg", status=200)
 
+    _response = None
     try:
         async with _SESSION_LOGOS.get(orig_url) as r:
             if r.status == 200:
-                logo_data = await r.read()
-                headers = {}
-                headers.setdefault("Content-Disposition", f'attachment; filename="{logo}"')
-                return response.HTTPResponse(
-                    body=logo_data, content_type="image/jpeg", headers=headers, status=200
-                )
-    except (ClientOSError, ServerDisconnectedError):
-        pass
+                headers = {"Content-Disposition": f'attachment; filename="{logo}"'}
+                _response = await request.respond(content_type="image/jpeg", headers=headers)
+                async for chunk in r.content.iter_chunked(16384):
+                    await _response.send(chunk)
+                return await _response.eof()
+    except (ClientOSError, ClientPayloadError, ServerDisconnectedError):
+        if _response:  # Headers already sent, drop the connection rather than end a truncated image
+            raise
     raise NotFound(f"Requested URL {request.raw_url.decode()} not found")
 
 
@@ -452,6 +483,71 @@ async def send_prom_event(event):
         pass
 
 
+class UdpRelay:
+    """
+    Read datagrams straight into a reusable buffer, so they can be relayed in batches.
+    """
+
+    def __init__(self, sock, skip=0):
+        sock.setblocking(False)
+        self.loop = asyncio.get_running_loop()
+        self.sock, self.skip = sock, skip
+        self.view = memoryview(bytearray(UDP_BATCH + UDP_MTU))
+
+        if recvmmsg:
+            self.slots = memoryview(bytearray(UDP_VLEN * UDP_MTU))
+            self._slots = (ctypes.c_char * len(self.slots)).from_buffer(self.slots)
+            self.iovecs = (Iovec * UDP_VLEN)()
+            self.msgs = (Mmsghdr * UDP_VLEN)()
+            for i in range(UDP_VLEN):
+                self.iovecs[i].iov_base = ctypes.addressof(self._slots) + i * UDP_MTU
+                self.iovecs[i].iov_len = UDP_MTU
+                self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+                self.msgs[i].msg_hdr.msg_iovlen = 1
+
+    def _recv_batch(self, size):
+        while size < UDP_BATCH:
+            vlen = (UDP_BATCH - size - 1) // UDP_MTU + 1
+            count = recvmmsg(self.sock.fileno(), self.msgs, vlen, socket.MSG_DONTWAIT, None)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise OSError(err, os.strerror(err))
+
+            for i in range(count):
+                start, length = i * UDP_MTU + self.skip, max(self.msgs[i].msg_len - self.skip, 0)
+                self.view[size : size + length] = self.slots[start : start + length]
+                size += length
+
+            if count < vlen:
+                break
+        return size
+
+    def _strip(self, offset, size):
+        if self.skip:
+            size = max(size - self.skip, 0)
+            self.view[offset : offset + size] = self.view[offset + self.skip : offset + self.skip + size]
+        return size
+
+    def close(self):
+        self.sock.close()
+
+    async def read(self):
+        size = self._strip(0, await self.loop.sock_recv_into(self.sock, self.view[:UDP_MTU]))
+
+        if recvmmsg:
+            return bytes(self.view[: self._recv_batch(size)])
+
+        while size < UDP_BATCH:  # Drain whatever is already queued, without waiting
+            try:
+                size += self._strip(size, self.sock.recv_into(self.view[size : size + UDP_MTU]))
+            except BlockingIOError:
+                break
+
+        return bytes(self.view[:size])
+
+
 class VodHttpProtocol(HttpProtocol, metaclass=TouchUpMeta):
     def connection_made(self, transport):
         """
@@ -10,11 +10,13 @@ import asyncio
 import logging
 import os
 import psutil
+import socket
 import sys
 import time
 import ujson
 import urllib.parse
 
+from aiohttp import ClientTimeout
 from aiohttp.client_exceptions import ClientOSError, ServerDisconnectedError
 from aiohttp.resolver import AsyncResolver
 from asyncio.subprocess import DEVNULL, PIPE, STDOUT
@@ -33,37 +35,62 @@ from mu7d import find_free_port, get_iptv_ip, glob_safe, mu7d_config, ongoing_vo
 
 log = logging.getLogger("VOD")
 
+RTSP_TIMEOUT = 10
+RTSP_UA = b"User-Agent: MICA-IP-STB\r\n"
+
 
 class RtspClient:
     def __init__(self, reader, writer, url):
-        self.reader, self.writer, self.url = reader, writer, url
+        self.reader, self.writer, self.url = reader, writer, url.encode()
         self.cseq = 1
 
     def close_connection(self):
         self.writer.close()
 
     async def send_request(self, method, headers):
-        headers["CSeq"] = self.cseq
-        req = f"{method} {self.url} RTSP/1.0\r\n{self.serialize_headers(headers)}\r\n\r\n"
-
-        self.writer.write(req.encode())
-        resp = (await self.reader.read(4096)).decode().splitlines()
+        cseq, self.cseq = self.cseq, self.cseq + 1
+        req = b"%s %s RTSP/1.0\r\nCSeq: %d\r\n%s%s\r\n" % (method, self.url, cseq, RTSP_UA, headers)
 
-        # log.debug(f"[{self.cseq}]: Req = [{'|'.join(req.splitlines())}]")
-        # log.debug(f"[{self.cseq}]: Resp = [{'|'.join(resp)}]")
+        try:
+            self.writer.write(req)
+            await self.writer.drain()
+            resp = await asyncio.wait_for(self.read_message(), RTSP_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):  # A lost connection fails the request like a timeout
+            return
 
-        self.cseq += 1
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"[{cseq}]: Req = [{'|'.join(req.decode().rstrip().splitlines())}]")
+            log.debug(f"[{cseq}]: Resp = [{resp[0].decode() if resp else resp}]")
 
-        if not resp or not resp[0].endswith("200 OK"):
+        if not resp or resp[0][9:12] != b"200":  # Status code right after "RTSP/1.0 "
             return
 
-        if method == "SETUP":
-            return resp[1].split(": ")[1].split(";")[0]
+        if method == b"SETUP":
+            session = resp[1].get(b"session")
+            return session.decode() if session else None
 
         return True
 
+    async def read_message(self):
+        try:
+            head = await self.reader.readuntil(b"\r\n\r\n")
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            return
+
+        status, *lines = head[:-4].split(b"\r\n")
+        # Header names are case-insensitive, so they are stored lower-cased
+        fields = (line.partition(b":") for line in lines)
+        headers = {name.strip().lower(): value.strip() for name, sep, value in fields if sep}
+        if b"content-length" in headers:  # Consume the body so it is not taken as the next message
+            try:
+                await self.reader.readexactly(int(headers[b"content-length"]))
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                return
+
+        return status, headers
+
     def serialize_headers(self, headers):
-        return "\r\n".join(map(lambda x: "{0}: {1}".format(*x), headers.items()))
+        return "".join(f"{k}: {v}\r\n" for k, v in headers.items()).encode()
 
 
 def _cleanup(ext, meta=False, subs=False):
@@ -168,7 +195,7 @@ async def postprocess(archive_params, archive_url, mtime, record_time):
 
                     params = {"action": "epgInfov2", "productID": _args.program, "channelID": _args.channel}
                     async with _SESSION_CLOUD.get(URL_MVTV, params=params) as resp:
-                        metadata = (await resp.json())["resultData"]
+                        metadata = (await resp.json(loads=ujson.loads))["resultData"]
 
                     data = ujson.dumps({"data": metadata}, ensure_ascii=False, indent=4, sort_keys=True)
                     async with aiofiles.open(cache_metadata, "w", encoding="utf8") as f:
@@ -518,46 +545,77 @@ async def record_stream(vod_info):
 async def rtsp(vod_info):
     # Open the RTSP session
     uri = urllib.parse.urlparse(vod_info["url"])
-    reader, writer = await asyncio.open_connection(uri.hostname, uri.port)
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(uri.hostname, uri.port), RTSP_TIMEOUT)
+    sock = writer.get_extra_info("socket")
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if hasattr(socket, "TCP_QUICKACK"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+    if hasattr(socket, "TCP_USER_TIMEOUT"):  # Drop the session when the server stops acknowledging
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, 15000)
     client = RtspClient(reader, writer, vod_info["url"])
+    record = __name__ == "__main__" and _args.write_to_file
 
-    header = {"User-Agent": "MICA-IP-STB"}
-    setup = {**header, "CSeq": "", "Transport": f"MP2T/H2221/UDP;unicast;client_port={_args.client_port}"}
-    session = {**header, "Session": await client.send_request("SETUP", setup), "CSeq": ""}
+    setup = client.serialize_headers({"Transport": f"MP2T/H2221/UDP;unicast;client_port={_args.client_port}"})
+    session = await client.send_request(b"SETUP", setup)
+    if not session:
+        return client.close_connection()
 
-    play = {**session, "Range": f"npt={_args.start:.3f}-end"}
-    play.update({"Scale": "1.000", "x-playNow": "", "x-noFlush": ""})
+    session, _, session_timeout = session.partition(";timeout=")
+    session = client.serialize_headers({"Session": session})
+    session_timeout = session_timeout.split(";")[0]
+    # Keep alive at half the session timeout the server announces, 30s when it does not announce one
+    interval = int(session_timeout) / 2 if session_timeout.isdigit() and int(session_timeout) else 30
+
+    play = {"Range": f"npt={_args.start:.3f}-end", "Scale": "1.000", "x-playNow": "", "x-noFlush": ""}
+    play = session + client.serialize_headers(play)
 
     # Start playing the VOD stream
-    if not await client.send_request("PLAY", play):
+    if not await client.send_request(b"PLAY", play):
         return client.close_connection()
 
+    msg_t = rec_t = None
     try:
-        if __name__ == "__main__":
-            if _args.write_to_file:
-                # Start recording the VOD stream
-                rec_t = asyncio.create_task(record_stream(vod_info))
-            else:
-                log.info(f'The VOD stream can be accesed at: "{_local_url}"')
-
-        # Start the RTSP keep alive loop
+        if record:
+            # Start recording the VOD stream
+            rec_t = asyncio.create_task(record_stream(vod_info))
+        elif __name__ == "__main__":
+            log.info(f'The VOD stream can be accesed at: "{_local_url}"')
+
+        # Start the RTSP keep alive loop, which also watches for the server closing the session
+        keepalive = time.monotonic() + interval
         while True:
-            if __name__ == "__main__" and _args.write_to_file:
-                done, pending = await asyncio.wait({rec_t}, timeout=30)
-                if rec_t in done:
+            msg_t = asyncio.create_task(client.read_message())
+            tasks = {msg_t, rec_t} if record else {msg_t}
+            wait = max(keepalive - time.monotonic(), 0)
+            done, pending = await asyncio.wait(tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+
+            if msg_t in done:
+                if not msg_t.result():
+                    log.debug("RTSP connection lost")
                     break
-            else:
-                await asyncio.sleep(30)
-            if not await client.send_request("GET_PARAMETER", session):
+                log.debug(f"RTSP server message: {msg_t.result()}")
+                continue
+
+            msg_t.cancel()
+            await asyncio.wait({msg_t})
+            if rec_t in done:
                 break
 
+            if not await client.send_request(b"GET_PARAMETER", session):
+                break
+            keepalive = time.monotonic() + interval
+
     finally:
+        if msg_t and not msg_t.done():
+            msg_t.cancel()
+            await asyncio.wait({msg_t})
+
         # Close the RTSP session, reducing bandwith
-        await client.send_request("TEARDOWN", session)
+        await client.send_request(b"TEARDOWN", session)
         client.close_connection()
         log.debug("RTSP loop ended")
 
-        if __name__ == "__main__" and _args.write_to_file:
+        if rec_t:
             if not rec_t.done():
                 await rec_t
 
@@ -583,14 +641,18 @@ async def Vod(args=None, vod_client=None):
         _SESSION_CLOUD = vod_client
         _args = args
 
-    async def _get_info():
-        params = {"action": "getRecordingData" if _args.cloud else "getCatchUpUrl"}
-        params.update({"extInfoID": _args.program, "channelID": _args.channel, "mode": 1})
+    params = {
+        "action": "getRecordingData" if _args.cloud else "getCatchUpUrl",
+        "extInfoID": _args.program,
+        "channelID": _args.channel,
+        "mode": 1,
+    }
 
+    async def _get_info():
         try:
-            async with _SESSION_CLOUD.get(URL_MVTV, params=params) as r:
-                return (await r.json())["resultData"]
-        except (ClientOSError, KeyError, ServerDisconnectedError, TypeError) as ex:
+            async with _SESSION_CLOUD.get(URL_MVTV, params=params, timeout=ClientTimeout(total=5)) as r:
+                return (await r.json(loads=ujson.loads))["resultData"]
+        except (ClientOSError, KeyError, ServerDisconnectedError, TypeError, asyncio.TimeoutError) as ex:
             log.error(f"{repr(ex)}")
 
     # Get info about the requested program from Movistar. Attempt it twice.
@@ -667,7 +729,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     if not _args.client_port:
-        _args.client_port = find_free_port(get_iptv_ip())
+        _args.client_port = find_free_port(iptv)
 
     _local_url = f"udp://@{iptv}:{_args.client_port}"
 
@@ -54,6 +54,23 @@ title_1_regex = re.compile(r"(.+(?!T\d)) +T(\d+)(?: *Ep?.? *(\d+))?[ -]*(.*)")
 title_2_regex = re.compile(r"(.+(?!T\d))(?: +T(\d+))? *Ep?.? *(\d+)[ -]*(.*)")
 
 
+class SafeFilenameTable(dict):
+    """
+    Translation table for get_safe_filename(), filled lazily with each character as it is seen.
+    """
+
+    def __init__(self):
+        super().__init__({ord(":"): ",", ord("("): "[", ord(")"): "]"})
+        self.update({ord(c): c for c in " ,._-¡![]"})
+
+    def __missing__(self, key):
+        self[key] = chr(key) if chr(key).isalnum() else None
+        return self[key]
+
+
+safe_filename_table = SafeFilenameTable()
+
+
 def find_free_port(iface=""):
     with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
         s.bind((iface, 0))
@@ -78,9 +95,7 @@ def get_lan_ip():
 
 
 def get_safe_filename(filename):
-    filename = filename.replace(":", ",").replace("...", "…").replace("(", "[").replace(")", "]")
-    keepcharacters = (" ", ",", ".", "_", "-", "¡", "!", "[", "]")
-    return "".join(c for c in filename if c.isalnum() or c in keepcharacters).rstrip()
+    return filename.replace("...", "…").translate(safe_filename_table).rstrip()
 
 
 def get_title_meta(title, serie_id=None):
@@ -237,6 +252,7 @@ def mu7d_config():
 
     if "U7D_THREADS" not in conf:
         conf["U7D_THREADS"] = 1
+    conf["U7D_THREADS"] = min(conf["U7D_THREADS"], os.cpu_count())
 
     conf["CHANNELS"] = os.path.join(conf["HOME"], "MovistarTV.m3u")
     conf["CHANNELS_CLOUD"] = os.path.join(conf["HOME"], "MovistarTVCloud.m3u")